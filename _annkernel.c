@@ -0,0 +1,205 @@
+/*
+ * Hand vectorized kernels for small layers, loaded by kernels.py with ctypes.
+ * Every kernel checks the cpu at runtime and falls back to plain C, so the
+ * library can be built without any -m flag:
+ *
+ *     gcc -O3 -ffast-math -shared -fPIC -o _annkernel.so _annkernel.c
+ */
+#include <math.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+#define ANN_X86 1
+#endif
+
+static inline int load_u32(const uint8_t *p)
+{
+    int32_t v;
+    memcpy(&v, p, sizeof(v));
+    return v;
+}
+
+#ifdef ANN_X86
+static int has_avx2(void)
+{
+    static int supported = -1;
+    if (supported < 0) {
+        __builtin_cpu_init();
+        supported = __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma");
+    }
+    return supported;
+}
+
+static int has_avx512_vnni(void)
+{
+    static int supported = -1;
+    if (supported < 0) {
+        __builtin_cpu_init();
+        supported = __builtin_cpu_supports("avx512f")
+            && __builtin_cpu_supports("avx512bw")
+            && __builtin_cpu_supports("avx512vnni");
+    }
+    return supported;
+}
+
+__attribute__((target("avx2,fma")))
+static void layer_forward_avx2(const float *W, const float *x, float *z, int n, int m)
+{
+    for (int i = 0; i < n; i++) {
+        const float *row = W + (size_t)i * m;
+        __m256 acc0 = _mm256_setzero_ps();
+        __m256 acc1 = _mm256_setzero_ps();
+        int k = 0;
+        for (; k + 16 <= m; k += 16) {
+            acc0 = _mm256_fmadd_ps(_mm256_loadu_ps(row + k), _mm256_loadu_ps(x + k), acc0);
+            acc1 = _mm256_fmadd_ps(_mm256_loadu_ps(row + k + 8), _mm256_loadu_ps(x + k + 8), acc1);
+        }
+        for (; k < m; k += 8)
+            acc0 = _mm256_fmadd_ps(_mm256_loadu_ps(row + k), _mm256_loadu_ps(x + k), acc0);
+
+        /* horizontal sum of the 8 lanes */
+        acc0 = _mm256_add_ps(acc0, acc1);
+        __m128 sum = _mm_add_ps(_mm256_castps256_ps128(acc0), _mm256_extractf128_ps(acc0, 1));
+        sum = _mm_hadd_ps(sum, sum);
+        sum = _mm_hadd_ps(sum, sum);
+        z[i] = _mm_cvtss_f32(sum);
+    }
+}
+
+__attribute__((target("avx512f,avx512bw,avx512vnni")))
+static void gemm4_i8_vnni_avx512(const int8_t *W, const uint8_t *xq, const int32_t *w_sum,
+                                 int32_t *out, int n, int m)
+{
+    /*
+     * the four rows of x share every load of W and their dpbusd chains
+     * overlap, every 4 bytes of x are broadcast straight from memory
+     */
+    const uint8_t *x0 = xq, *x1 = xq + m, *x2 = xq + 2 * (size_t)m, *x3 = xq + 3 * (size_t)m;
+    for (int rb = 0; rb < n; rb += 16) {
+        const int8_t *block = W + (size_t)rb * m;
+        __m512i acc0 = _mm512_setzero_si512();
+        __m512i acc1 = _mm512_setzero_si512();
+        __m512i acc2 = _mm512_setzero_si512();
+        __m512i acc3 = _mm512_setzero_si512();
+        for (int k = 0; k < m; k += 4) {
+            __m512i wb = _mm512_loadu_si512((const void *)(block + (size_t)k * 16));
+            acc0 = _mm512_dpbusd_epi32(acc0, _mm512_set1_epi32(load_u32(x0 + k)), wb);
+            acc1 = _mm512_dpbusd_epi32(acc1, _mm512_set1_epi32(load_u32(x1 + k)), wb);
+            acc2 = _mm512_dpbusd_epi32(acc2, _mm512_set1_epi32(load_u32(x2 + k)), wb);
+            acc3 = _mm512_dpbusd_epi32(acc3, _mm512_set1_epi32(load_u32(x3 + k)), wb);
+        }
+        __m512i bias = _mm512_slli_epi32(_mm512_loadu_si512((const void *)(w_sum + rb)), 7);
+        _mm512_storeu_si512((void *)(out + rb), _mm512_sub_epi32(acc0, bias));
+        _mm512_storeu_si512((void *)(out + n + rb), _mm512_sub_epi32(acc1, bias));
+        _mm512_storeu_si512((void *)(out + 2 * (size_t)n + rb), _mm512_sub_epi32(acc2, bias));
+        _mm512_storeu_si512((void *)(out + 3 * (size_t)n + rb), _mm512_sub_epi32(acc3, bias));
+    }
+}
+#endif
+
+/* z = W @ x for a row major (n, m) W, m must be a multiple of 8 */
+void layer_forward(const float *W, const float *x, float *z, int n, int m)
+{
+#ifdef ANN_X86
+    if (has_avx2()) {
+        layer_forward_avx2(W, x, z, n, m);
+        return;
+    }
+#endif
+    for (int i = 0; i < n; i++) {
+        const float *row = W + (size_t)i * m;
+        float acc = 0;
+        for (int k = 0; k < m; k++)
+            acc += row[k] * x[k];
+        z[i] = acc;
+    }
+}
+
+/*
+ * out = x @ W.T in int32 for four int8 rows x of width m, stored shifted by
+ * 128 into the unsigned range (dpbusd multiplies unsigned by signed bytes,
+ * 128 * sum(row) is removed afterwards), and an int8 W packed in blocks of
+ * 16 rows x 4 columns: block (r, k) holds W[16r + i][4k + j] at offset
+ * 4i + j, blocks are stored row block by row block. n must be a multiple of
+ * 16 and m a multiple of 4, w_sum holds the sum of every row of W
+ */
+static void gemm4_i8(const int8_t *W, const uint8_t *xq, const int32_t *w_sum,
+                     int32_t *out, int n, int m)
+{
+#ifdef ANN_X86
+    if (has_avx512_vnni()) {
+        gemm4_i8_vnni_avx512(W, xq, w_sum, out, n, m);
+        return;
+    }
+#endif
+    (void)w_sum;
+    for (int r = 0; r < 4; r++) {
+        const uint8_t *x = xq + (size_t)r * m;
+        for (int rb = 0; rb < n; rb += 16) {
+            const int8_t *block = W + (size_t)rb * m;
+            int32_t acc[16] = {0};
+            for (int k = 0; k < m; k += 4)
+                for (int i = 0; i < 16; i++)
+                    for (int j = 0; j < 4; j++)
+                        acc[i] += ((int32_t)x[k + j] - 128) * block[(size_t)k * 16 + i * 4 + j];
+            memcpy(out + (size_t)r * n + rb, acc, sizeof(acc));
+        }
+    }
+}
+
+/*
+ * the k inputs x followed by the bias input 1 and zero padding up to m,
+ * quantized to int8 and shifted by 128, returns the scale
+ */
+#ifdef ANN_X86
+__attribute__((target_clones("avx512f", "avx2", "default")))
+#endif
+static float quantize_row(const float *x, uint8_t *q, int k, int m)
+{
+    float top = 1;
+    for (int j = 0; j < k; j++)
+        top = fmaxf(top, fabsf(x[j]));
+    float scale = top / 127;
+    float inv = 1 / scale;
+    for (int j = 0; j < k; j++) {
+        float v = x[j] * inv;
+        q[j] = (uint8_t)((int)(v + (v >= 0 ? 0.5f : -0.5f)) + 128);
+    }
+    q[k] = (uint8_t)((int)(inv + 0.5f) + 128);
+    memset(q + k + 1, 128, (size_t)(m - k - 1));
+    return scale;
+}
+
+/*
+ * z = [X, 1] @ W.T for a row major float (batch, k) X, the bias input and
+ * the zero padding up to the width m of W are added here. Every row is
+ * quantized to int8 with its own scale, four rows at a time go through
+ * gemm4_i8 and are scaled back with w_scale, only the first n_out rows of
+ * W are kept
+ */
+void gemm_i8_vnni(const int8_t *W, const float *X, const int32_t *w_sum, const float *w_scale,
+                  float *z, int n, int m, int k, int n_out, int batch)
+{
+    uint8_t *xq = malloc(4 * (size_t)m);
+    int32_t *acc = malloc(4 * (size_t)n * sizeof(int32_t));
+    float scales[4];
+    memset(xq, 128, 4 * (size_t)m);
+    for (int b0 = 0; b0 < batch; b0 += 4) {
+        int rows = batch - b0 < 4 ? batch - b0 : 4;
+        for (int r = 0; r < rows; r++)
+            scales[r] = quantize_row(X + (size_t)(b0 + r) * k, xq + (size_t)r * m, k, m);
+
+        gemm4_i8(W, xq, w_sum, acc, n, m);
+        for (int r = 0; r < rows; r++) {
+            float *row = z + (size_t)(b0 + r) * n_out;
+            for (int i = 0; i < n_out; i++)
+                row[i] = acc[(size_t)r * n + i] * (w_scale[i] * scales[r]);
+        }
+    }
+    free(xq);
+    free(acc);
+}
@@ -1,7 +1,8 @@
 import numpy as np
 
 def softmax(x):
-    return np.exp(x)  
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
 
 def sigmoid(x):
     return 1 / (1 + np.exp(-x))
@@ -10,7 +11,7 @@ def relu(x):
     return np.maximum(0, x)
 
 def sign(x):
-    return 1 if x > 0 else -1
+    return np.where(x > 0, 1, -1)
 
 def linear(x):
     return x
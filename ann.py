@@ -3,62 +3,122 @@ from typing import Callable
 import activations
 import deltafuncs
 import deltacoef
+import kernels
 import networkx as nx
 import matplotlib.pyplot as plt
-import random
 from enum import Enum
 import pickle
 from numpy import log
+from importlib import import_module
+
+try:
+    from scipy.linalg.blas import sger, dger
+    # in place rank-1 update (a += alpha * x y^T) per dtype, used by
+    # Layer.calc. fit trains through Model._batch_propagate, so only direct
+    # Model.propagate calls take this path
+    _GER = {np.dtype(np.float32): sger, np.dtype(np.float64): dger}
+except ImportError:
+    _GER = {}
+
+# array module backing each supported device
+DEVICES = {
+    'cpu': 'numpy',
+    'cuda': 'cupy',
+}
+
+# weight rows (and the inputs they are multiplied with) are zero padded to
+# a multiple of the AVX2 float32 lane count, so dot products have no tail
+SIMD_WIDTH = 8
+
+def pad_width(size: int) -> int:
+    return (size + SIMD_WIDTH - 1) & ~(SIMD_WIDTH - 1)
+
+# the AVX2 kernel of _annkernel.c goes through ctypes, which costs more than
+# numpy's W @ x on small layers, and BLAS is as fast on large ones, so it is
+# only used when enabled explicitly
+USE_C_KERNEL = False
+
+def resolve_dtype(dtype):
+    # bfloat16 is not a numpy type, it is only usable through jax/ml_dtypes
+    if dtype == 'bfloat16':
+        try:
+            from jax.numpy import bfloat16
+        except ImportError:
+            try:
+                from ml_dtypes import bfloat16
+            except ImportError:
+                raise ValueError("bfloat16 requires jax or ml_dtypes to be installed")
+        return np.dtype(bfloat16)
+    return np.dtype(dtype)
+
+def to_numpy(a):
+    # copy device (cupy) arrays back to host memory
+    return a.get() if hasattr(a, 'get') else np.asarray(a)
+
+# layers with more weights than this only print their shape, unless verbose
+REPR_MAX_WEIGHTS = 100
+
+# activation, output layer delta and hidden layer delta coefficient of
+# every supported activation, resolved once per layer
+_ACT_TABLE = {
+    name: (getattr(activations, name), getattr(deltafuncs, name), getattr(deltacoef, name))
+    for name in kernels.ACT_IDS
+}
 
 class StopReason(Enum):
     MAX_ITERATIONS = 1
     ERROR_THRESHOLD = 2
 
 class Neuron(object):
-    def __init__(
-        self,
-        activation: Callable | str = 'sigmoid',
-        weights: list[float] = None,
-    ):
-        self.activation = activation
-        if isinstance(activation, str):
-            self.activation: Callable = getattr(activations, activation)
-            self.delta_func: Callable = getattr(deltafuncs, activation)
-            self.delta_coef: Callable = getattr(deltacoef, activation)
-        self.weights = weights
-        self.value = 0
-        self.delta_err = 0
-        self.delta_weights = [0 for _ in range(len(weights))]
-        self.relu_flag = False
-
-    def __call__(self, x: list[float]):
-        # feed forward
-        val = np.dot(x, self.weights)
-        self.relu_flag = val < 0
-        self.value = self.activation(val)
-        return self.value
+    # view over one row of the arrays owned by a Layer
+    __slots__ = ('layer', 'index')
 
-    def __repr__(self):
-        return f'Neuron({self.activation.__name__}, {self.weights})'
+    def __init__(self, layer: 'Layer', index: int):
+        self.layer = layer
+        self.index = index
 
-    def reset_value(self):
-        self.value = 0
+    @property
+    def activation(self) -> Callable:
+        return self.layer.activation
 
-    def reset_delta_err(self):
-        self.delta_err = 0
+    @property
+    def weights(self) -> np.ndarray:
+        return self.layer.W[self.index, :self.layer._real_in]
 
-    def reset_delta_weights(self):
-        self.delta_weights = [0 for _ in range(len(self.weights))]
-    
-    def update_weights(self):
-        for i in range(len(self.delta_weights)):
-            self.weights[i] += self.delta_weights[i]
+    @property
+    def delta_weights(self) -> np.ndarray:
+        return self.layer.dW[self.index, :self.layer._real_in]
+
+    @property
+    def value(self) -> float:
+        return self.layer.values[self.index]
+
+    @value.setter
+    def value(self, value: float):
+        self.layer.values[self.index] = value
+
+    @property
+    def delta_err(self) -> float:
+        return self.layer.delta_err[self.index]
+
+    @delta_err.setter
+    def delta_err(self, delta_err: float):
+        self.layer.delta_err[self.index] = delta_err
+
+    def __repr__(self):
+        return f'Neuron({self.activation.__name__}, {self.weights})'
 
 class LayerType(Enum):
     OUTPUT = 1
     HIDDEN = 2
 
 class Layer(object):
+    __slots__ = (
+        'name', 'activation_type', 'activation', 'delta_func', 'delta_coef', 'act_id',
+        'dtype', '_real_in', 'W', 'dW', 'output', 'delta_err', 'neurons',
+        'bias', 'input_shape', 'device', 'xp', 'quantized', '_Wq', '_Wq_sum', '_Wq_scale',
+    )
+
     def __init__(
         self,
         neurons: list[Neuron] | int,
@@ -67,50 +127,140 @@ class Layer(object):
         weights: list[list[float]] = None,
         bias: float = 1,
         input_shape=0,
+        dtype=np.float32,
     ) -> None:
         self.name = name
         if not isinstance(activation, str):
             raise TypeError("activation must be string")
         
+        if activation not in _ACT_TABLE:
+            raise ValueError(f"activation must be one of {list(_ACT_TABLE)}")
+
         self.activation_type = activation
-        self.activation: Callable = getattr(activations, activation)
-        self.delta_func: Callable = getattr(deltafuncs, activation)
-        self.delta_coef: Callable = getattr(deltacoef, activation)
-
-        self.neurons = neurons
-        if isinstance(neurons, int):
-            self.neurons: list[Neuron] = [
-                Neuron(activation, weights[i] if weights else 0)
-                for i in range(neurons)
-            ]
+        self.activation, self.delta_func, self.delta_coef = _ACT_TABLE[activation]
+        self.act_id = kernels.ACT_IDS[activation]
+
+        if not isinstance(neurons, int):
+            weights = [neuron.weights for neuron in neurons]
+            neurons = len(neurons)
+
+        self.dtype = resolve_dtype(dtype)
+        if weights is None:
+            weights = np.zeros((neurons, input_shape + 1))
+        self._set_weights(weights)
         self.bias = bias
         self.input_shape = input_shape
+        self.device = 'cpu'
+        self.xp = np
+        self.quantized = False
+        self._Wq = None
+        self._Wq_sum = None
+        self._Wq_scale = None
+
+    def _set_weights(self, weights: list[list[float]]):
+        # the layer owns its state as one array per quantity (one row or
+        # entry per neuron, bias weight after the input weights, then zero
+        # padding), neurons are views over them
+        weights = np.asarray(weights, dtype=self.dtype)
+        neurons = weights.shape[0]
+        self._real_in = weights.shape[1]
+        self.W = np.zeros((neurons, pad_width(self._real_in)), dtype=self.dtype)
+        self.W[:, :self._real_in] = weights
+        assert self.W.flags.c_contiguous
+        self.dW = np.zeros_like(self.W)
+        # values of the neurons followed by the bias input of the next layer,
+        # padded like the weight rows of the next layer
+        self.output = np.zeros(pad_width(neurons + 1), dtype=self.dtype)
+        self.output[neurons] = 1
+        self.delta_err = np.zeros(neurons, dtype=self.dtype)
+        self.neurons = [Neuron(self, i) for i in range(neurons)]
+
+    @property
+    def values(self):
+        return self.output[:len(self.neurons)]
+
+    def to(self, device: str, dtype=None):
+        if device not in DEVICES:
+            raise ValueError(f"device must be one of {list(DEVICES)}")
+        self.device = device
+        # resolved once, the array module is used on every call
+        self.xp = xp = import_module(DEVICES[device])
+        if dtype is not None:
+            self.dtype = resolve_dtype(dtype)
+        self.W = xp.asarray(to_numpy(self.W), dtype=self.dtype)
+        self.dW = xp.asarray(to_numpy(self.dW), dtype=self.dtype)
+        self.output = xp.asarray(to_numpy(self.output), dtype=self.dtype)
+        self.delta_err = xp.asarray(to_numpy(self.delta_err), dtype=self.dtype)
+
+    def __getstate__(self):
+        # modules can not be pickled, xp is resolved again from the device
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'xp'}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.xp = import_module(DEVICES[self.device])
 
     def get_output_shape(self):
         return len(self.neurons)
     
     def get_values(self):
-        return [neuron.value for neuron in self.neurons]
+        return self.values
 
     def get_params_count(self):
         return (self.input_shape + 1) * len(self.neurons) 
 
     def get_weights(self):
-        return np.array([neuron.weights for neuron in self.neurons])
-
-    def __call__(self, inputs: list[float]) -> list[float]:
-        # feed forward
-        out = [neuron(inputs) for neuron in self.neurons]
-        if self.activation is activations.softmax: # TODO: RECHECK
-            out = (out / sum(out)).tolist()
-        for i in range(len(out)):
-            self.neurons[i].value = out[i]
-        return out
+        return self.W[:, :self._real_in]
+
+    def __call__(self, inputs: list[float]) -> np.ndarray:
+        # feed forward, inputs end with the bias and may already be padded
+        x = self.xp.asarray(inputs, dtype=self.dtype)
+        if x.shape[0] < self.W.shape[1]:
+            x = self.xp.concatenate([x, self.xp.zeros(self.W.shape[1] - x.shape[0], dtype=self.dtype)])
+        if self.quantized:
+            z = self._forward_int8(x[None, :self._real_in - 1])[0]
+        elif USE_C_KERNEL and kernels.c_lib is not None and self.device == 'cpu' and self.dtype == np.float32:
+            z = self._forward_c(x)
+        else:
+            z = self.W @ x
+        # overwrites every value, so the values never need to be reset
+        self.values[:] = self.activation(z)
+        return self.values
+
+    def _forward_c(self, x: np.ndarray) -> np.ndarray:
+        z = np.empty(self.W.shape[0], dtype=np.float32)
+        kernels.layer_forward(self.W, np.ascontiguousarray(x), z)
+        return z
+
+    def quantize(self):
+        # int8 copy of the weights (one scale per neuron) used for inference
+        # until the weights are updated again
+        if self.device != 'cpu':
+            raise ValueError("quantization is only supported on the cpu device")
+        W = self.W.astype(np.float32)
+        scale = np.abs(W).max(axis=1) / 127
+        scale[scale == 0] = 1
+        W_q = np.round(W / scale[:, None]).astype(np.int8)
+        self._Wq, self._Wq_sum = kernels.pack_int8(W_q)
+        self._Wq_scale = scale
+        self.quantized = True
+
+    def _forward_int8(self, X: np.ndarray) -> np.ndarray:
+        # X holds one row of inputs per sample, the bias is added by gemm_i8
+        return kernels.gemm_i8(self._Wq, X, self._Wq_sum, self._Wq_scale, len(self.neurons))
 
     def __repr__(self):
+        return self.describe()
+
+    def describe(self, verbose: bool = False):
         activation_name = self.activation.__name__
-        weights = self.get_transformed_weights()
         param_count = self.get_params_count()
+        shape = self.get_weights().shape
+        if verbose or shape[0] * shape[1] <= REPR_MAX_WEIGHTS:
+            weights = self.get_transformed_weights()
+        else:
+            weights = f'<{shape} {self.dtype}>'
 
         return ''.join([
             'Layer(',
@@ -120,68 +270,43 @@ class Layer(object):
             f'param_count={param_count}',
             ')',
         ])
-    
-    def reset_value(self):
-        for neuron in self.neurons:
-            neuron.reset_value()
 
-    def reset_delta_err(self):
-        for neuron in self.neurons:
-            neuron.reset_delta_err()
-        
     def reset_delta_weights(self):
-        for neuron in self.neurons:
-            neuron.reset_delta_weights()
+        self.dW.fill(0)
 
-    def calc(self, type: LayerType, prev_values: list[float], learning_rate: float, expected: list[float] = [], next_neurons: list[Neuron] = None):
+    def calc(self, type: LayerType, prev_values: np.ndarray, learning_rate: float, expected: list[float] = None, next_layer: 'Layer' = None):
+        # delta_err is overwritten, not accumulated, so it never needs a reset
         if (type == LayerType.OUTPUT):
-            for j in range(len(self.neurons)):
-                neuron = self.neurons[j]
-
-                if (self.activation_type == 'softmax'):
-                    neuron.reset_delta_err()
-                    cur_out = neuron.value
-                    for k in range(len(self.neurons)):
-                        other_out = self.neurons[k].value
-                        delta_val = self.delta_func(cur_out, other_out, j, k) * expected[k]
-                        neuron.delta_err += delta_val
-                elif (self.activation_type == 'relu'):
-                    neuron.delta_err = self.delta_func(expected[j], neuron.value, neuron.relu_flag)
-                else:
-                    neuron.delta_err = self.delta_func(expected[j], neuron.value)
-
-                for k, _ in enumerate(neuron.delta_weights): # TODO: RECHECK
-                    neuron.delta_weights[k] += -learning_rate * neuron.delta_err * prev_values[k]
+            expected = self.xp.asarray(expected, dtype=self.dtype)
+            self.delta_err[:] = self.delta_func(expected, self.values)
         elif (type == LayerType.HIDDEN):
-            for j in range(len(self.neurons)):
-                neuron = self.neurons[j]
-                sum = 0
-                for k in range(len(next_neurons)):
-                    next_neuron = next_neurons[k]
-                    sum += next_neuron.delta_err * next_neuron.weights[j]
-                
-                if (self.activation_type == 'relu'):
-                    neuron.delta_err = self.delta_coef(neuron.value, neuron.relu_flag) * sum
-                else:
-                    neuron.delta_err = self.delta_coef(neuron.value) * sum
-
-                for k in range(len(neuron.delta_weights)):
-                    neuron.delta_weights[k] += -learning_rate * neuron.delta_err * prev_values[k]
+            # drop the bias column, it is not connected to this layer
+            sums = next_layer.W[:, :len(self.neurons)].T @ next_layer.delta_err
+            self.delta_err[:] = self.delta_coef(self.values) * sums
+
+        ger = _GER.get(self.dtype) if self.device == 'cpu' else None
+        if ger is not None:
+            # dW.T is Fortran ordered, so ger updates dW without any copy. It
+            # is written back should f2py ever have to copy it
+            dW_T = ger(-learning_rate, prev_values, self.delta_err, a=self.dW.T, overwrite_a=1)
+            if not np.shares_memory(dW_T, self.dW):
+                self.dW[:] = dW_T.T
+        else:
+            self.dW -= learning_rate * self.xp.outer(self.delta_err, prev_values)
 
     def update_weights(self):
-        for i in range(len(self.neurons)):
-            self.neurons[i].update_weights()
+        # applies the accumulated deltas in place and clears them for the
+        # next batch
+        self.W += self.dW
+        self.dW.fill(0)
+        self.quantized = False
 
         
     def get_transformed_weights(self):
-        weights = self.get_weights()
-        bias = [b[-1] for b in weights]
-        weights = [w[:-1] for w in weights]
-        weights = [list(x) for x in zip(*weights)]
-        transformed_weights = [bias]
-        transformed_weights.extend(weights)
-
-        rounded = [[round(x1, 4) for x1 in x] for x in transformed_weights]
+        weights = to_numpy(self.get_weights())
+        transformed_weights = np.vstack([weights[:, -1], weights[:, :-1].T])
+
+        rounded = transformed_weights.astype(np.float64).round(4).tolist()
         return rounded
 
 class Model(object):
@@ -190,7 +315,11 @@ class Model(object):
         batch_size: int = 10,
         max_iterations: int = 100,
         error_threshold: float = 0.1,
+        device: str = 'cpu',
+        dtype=np.float32,
     ) -> None:
+        if device not in DEVICES:
+            raise ValueError(f"device must be one of {list(DEVICES)}")
         self.layers = layers
         if layers is None:
             self.layers: list[Layer] = []
@@ -198,23 +327,42 @@ class Model(object):
         self.batch_size = batch_size
         self.max_iteration = max_iterations
         self.error_threshold = error_threshold
+        self.device = device
+        self.xp = import_module(DEVICES[device])
+        self.dtype = resolve_dtype(dtype)
+        self._train_cache = None
+        self._acts = None
+        self._coefs = None
+        self._err_buf = None
+        self._propagate_fn = None
+        self._compiled_arch = None
+        for layer in self.layers:
+            layer.to(device, self.dtype)
 
     def add(self, layer: Layer) -> None:
         if self.layers:
             layer.input_shape = self.layers[-1].get_output_shape()
+            if layer._real_in != layer.input_shape + 1:
+                # layers built without weights only learn their input width here
+                if layer.W.any():
+                    raise ValueError("weights do not match the output of the previous layer")
+                layer._set_weights(np.zeros((len(layer.neurons), layer.input_shape + 1)))
+        layer.to(self.device, self.dtype)
         self.layers.append(layer)
 
     def get_params_count(self):
         return sum([layer.get_params_count() for layer in self.layers])
 
-    def summary(self):
+    def summary(self, verbose: bool = False):
         print(f'Model with {self.get_params_count()} parameters')
         print(f'Learning rate={self.learning_rate}')
         print(f'Batch size={self.batch_size}')
         print(f'Max iteration={self.max_iteration}')
         print(f'Error threshold={self.error_threshold}')
+        print(f'Device={self.device}')
+        print(f'Dtype={self.dtype}')
         for layer in self.layers:
-            print(layer)
+            print(layer.describe(verbose))
 
     def draw(self):
         graph = nx.DiGraph()
@@ -227,13 +375,15 @@ class Model(object):
         # draw hidden layers
         for i, layer in enumerate(self.layers):
             graph.add_node(f'b_{i}', color='black', pos=(i + 0.25, -layer.input_shape))
-            for j, neuron in enumerate(layer.neurons):
+            weights = to_numpy(layer.get_weights())
+            ys = -np.arange(len(weights)) + 0.1 * np.random.randint(-3, 3, size=len(weights))
+            for j, neuron_weights in enumerate(weights):
                 color = 'blue' if i < len(self.layers) - 1 else 'red'
                 cur_node = f'h_{i}_{j}' if i < len(self.layers) - 1 else f'o_{j}'
-                graph.add_node(cur_node, color=color, pos=(i+1, -j + random.randrange(-3, 3) * 0.1))
+                graph.add_node(cur_node, color=color, pos=(i+1, ys[j]))
 
-                for k, weight in enumerate(neuron.weights):
-                    src = f'b_{i}' if k == len(neuron.weights) - 1 else (f'i_{k}' if i == 0 else f'h_{i-1}_{k}')
+                for k, weight in enumerate(neuron_weights):
+                    src = f'b_{i}' if k == len(neuron_weights) - 1 else (f'i_{k}' if i == 0 else f'h_{i-1}_{k}')
                     graph.add_edge(src, cur_node, weight=weight)
             
         # draw graph
@@ -249,107 +399,239 @@ class Model(object):
         nx.draw_networkx_edge_labels(graph, pos, edge_labels=edge_labels, font_size=8, ax=plot)
 
 
+    def _input_vector(self, input: list[float]):
+        # input followed by the bias, padded to the width of the first layer
+        layer = self.layers[0]
+        x = self.xp.zeros(layer.W.shape[1], dtype=self.dtype)
+        x[:layer._real_in - 1] = self.xp.asarray(input, dtype=self.dtype)
+        x[layer._real_in - 1] = 1
+        return x
+
+    def _feed_forward(self, x: np.ndarray):
+        # every layer reads the output buffer (bias included) of the
+        # previous one
+        for layer in self.layers:
+            layer(x)
+            x = layer.output
+        return self.layers[-1].values
+
     def single_predict(self, input: list[float]):
-        out = list(input)
+        # the layer buffers are reused by the next call, callers get a copy
+        return self._feed_forward(self._input_vector(input)).copy()
+
+    def quantize(self):
         for layer in self.layers:
-            out.append(1)
-            out = layer(out)
-        return out
+            layer.quantize()
 
-    def __call__(self, inputs: list[list[float]]):
-        # feed forward
-        outputs: list[list[float]] = []
-        for input in inputs:
-            out = list(input)
-            for layer in self.layers:
-                out.append(1)
-                out = layer(out)
-            outputs.append(out)
-
-        return outputs
-
-    def get_prev_values(self, idx: int, inputs: list[float]):
-        bias = 1
-        if idx == 0:
-            return list(inputs.copy()) + [bias]
-        else:
-            return self.layers[idx-1].get_values() + [bias]
+    def __call__(self, inputs: list[list[float]]) -> np.ndarray:
+        # feed forward, one row of outputs per input
+        xp = self.xp
+        out = xp.asarray(inputs, dtype=self.dtype)
+        for layer in self.layers:
+            num_inputs = layer._real_in - 1
+            if layer.quantized:
+                out = layer.activation(layer._forward_int8(out))
+            else:
+                out = layer.activation(out @ layer.W[:, :num_inputs].T + layer.W[:, num_inputs])
+        return out
 
     def propagate(self, inputs: list[float], expected: list[float], learning_rate: float):
-        _ = self.single_predict(inputs)
+        x = self._input_vector(inputs)
+        _ = self._feed_forward(x)
 
         num = len(self.layers)
         for i in range(num-1, -1, -1):
             layer = self.layers[i]
-            prev_layer_values = self.get_prev_values(i, inputs)
+            prev_layer_values = x if i == 0 else self.layers[i-1].output
             if (i == (num-1)): # output layer
                 layer.calc(LayerType.OUTPUT, prev_layer_values, learning_rate, expected)
             else:
                 next_layer = self.layers[i+1]
-                layer.calc(LayerType.HIDDEN, prev_layer_values, learning_rate, None, next_layer.neurons)
-
-    def reset_value(self):
-        for layer in self.layers:
-            layer.reset_value()
-    
-    def reset_delta_err(self):
-        for layer in self.layers:
-            layer.reset_delta_err()
+                layer.calc(LayerType.HIDDEN, prev_layer_values, learning_rate, None, next_layer)
 
     def reset_delta_weights(self):
         for layer in self.layers:
             layer.reset_delta_weights()
 
-    def multi_propagates(self, inputs: list[list[float]], expected: list[list[float]], learning_rate: float):
-        num = len(inputs)
+    def _batch_propagate(self, inputs: list[list[float]], expected: list[list[float]], learning_rate: float):
+        xp = self.xp
+        X = xp.asarray(inputs, dtype=self.dtype)
+        Y = xp.ascontiguousarray(xp.asarray(expected, dtype=self.dtype))
+        acts, coefs = (self._acts, self._coefs) if self._acts is not None else self._alloc_buffers(len(X))
+        As = [A[:len(X)] for A in acts]
+        if self._propagate_fn is not None and self._compiled_arch == self._architecture():
+            self._propagate_fn(X, Y, learning_rate, As, [dA[:len(X)] for dA in coefs], self.layers)
+            return
+
+        As[0][:, :X.shape[1]] = X
+        if self._train_cache is not None:
+            Ws, dWs, act_ids = self._train_cache
+            kernels.train_step_batch(Ws, dWs, act_ids, As[0], Y, np.float32(learning_rate), kernels.get_num_threads())
+            return
+
+        # feed forward the whole batch, As[i] is the input of layer i (one
+        # padded row per sample, bias column after the inputs). The delta
+        # coefficients of the hidden layers are computed right away, while
+        # A is still hot
+        dAs = [dA[:len(X)] for dA in coefs]
+        num = len(self.layers)
+        for i, layer in enumerate(self.layers):
+            A = As[i+1][:, :len(layer.neurons)]
+            A[:] = layer.activation(As[i] @ layer.W.T)
+            if (i < (num-1)):
+                layer.delta_coef(A, out=dAs[i])
+
+        for i in range(num-1, -1, -1):
+            layer = self.layers[i]
+            if (i == (num-1)): # output layer
+                dE = layer.delta_func(Y, As[i+1][:, :len(layer.neurons)])
+            else:
+                next_layer = self.layers[i+1]
+                dE = dAs[i] * (dE @ next_layer.W[:, :len(layer.neurons)])
+            layer.dW -= learning_rate * (dE.T @ As[i])
+
+    def _architecture(self):
+        return tuple((layer._real_in, len(layer.neurons), layer.activation_type) for layer in self.layers)
+
+    def compile(self):
+        # generates _batch_propagate specialized for the current layer sizes
+        # and activations, it is used as long as the architecture does not
+        # change
+        if not self.layers:
+            raise ValueError("model has no layers to compile")
+        num = len(self.layers)
+        lines = [
+            'def propagate(X, Y, lr, As, dAs, layers):',
+            f'    {", ".join(f"l{i}" for i in range(num))}, = layers',
+        ]
         for i in range(num):
-            self.propagate(inputs[i], expected[i], learning_rate)
-            self.reset_value()
-            self.reset_delta_err()
+            lines.append(f'    W{i}, dW{i}, A{i} = l{i}.W, l{i}.dW, As[{i}]')
+        lines.append(f'    A{num} = As[{num}]')
+
+        # feed forward
+        lines.append(f'    A0[:, :{self.layers[0]._real_in - 1}] = X')
+        for i, layer in enumerate(self.layers):
+            n, act = len(layer.neurons), layer.activation_type
+            z = f'A{i} @ W{i}.T'
+            lines.append(f'    a{i+1} = A{i+1}[:, :{n}]')
+            lines.append(f'    a{i+1}[:] = {z}' if act == 'linear' else f'    a{i+1}[:] = _act_{act}({z})')
+            if i < num - 1 and act != 'linear':
+                lines.append(f'    _coef_{act}(a{i+1}, out=dAs[{i}])')
+
+        # back propagation
+        last = self.layers[-1].activation_type
+        lines.append(f'    dE{num-1} = _delta_{last}(Y, a{num})')
+        for i in range(num - 1, -1, -1):
+            if i < num - 1:
+                n, act = len(self.layers[i].neurons), self.layers[i].activation_type
+                sums = f'(dE{i+1} @ W{i+1}[:, :{n}])'
+                lines.append(f'    dE{i} = {sums}' if act == 'linear' else f'    dE{i} = dAs[{i}] * {sums}')
+            lines.append(f'    dW{i} -= lr * (dE{i}.T @ A{i})')
+
+        namespace = {}
+        for name, (activation, delta_func, delta_coef) in _ACT_TABLE.items():
+            namespace[f'_act_{name}'] = activation
+            namespace[f'_delta_{name}'] = delta_func
+            namespace[f'_coef_{name}'] = delta_coef
+        exec(compile('\n'.join(lines), '<ann>', 'exec'), namespace)
+        self._propagate_fn = namespace['propagate']
+        self._compiled_arch = self._architecture()
+
+    def _alloc_buffers(self, batch_size: int):
+        # one buffer per layer input (padded like the layer outputs), the
+        # bias column is filled only once
+        sizes = [self.layers[0]._real_in - 1]
+        sizes.extend(len(layer.neurons) for layer in self.layers)
+        acts = [self.xp.zeros((batch_size, pad_width(size + 1)), dtype=self.dtype) for size in sizes]
+        for A, size in zip(acts, sizes):
+            A[:, size] = 1
+
+        # one buffer of delta coefficients per hidden layer, relu only needs
+        # its mask
+        coefs = [
+            self.xp.empty(
+                (batch_size, len(layer.neurons)),
+                dtype=np.uint8 if layer.activation_type == 'relu' else self.dtype,
+            )
+            for layer in self.layers[:-1]
+        ]
+        return acts, coefs
 
     def update_weights(self):
-        for i in range(len(self.layers)):
-            layer = self.layers[i]
+        for layer in self.layers:
             layer.update_weights()
 
     def calc_total_err(self, inputs: list[list[float]], expected: list[list[float]]):
+        xp = self.xp
         res = self(inputs)
-
-        total_err = 0
-        flag_softmax = self.layers[-1].activation_type == 'softmax'
-        for i in range(len(res)):
-            if (flag_softmax):
-                for j1 in range(len(res[0])):
-                    total_err += -(expected[i][j1] * log(res[i][j1]))
-            for j in range(len(res[i])):
-                total_err += 0.5 * (res[i][j] - expected[i][j]) ** 2
+        expected = xp.asarray(expected, dtype=self.dtype)
+        if self._err_buf is None or self._err_buf.shape != res.shape:
+            self._err_buf = xp.empty_like(res)
+
+        diff = xp.subtract(res, expected, out=self._err_buf)
+        total_err = 0.5 * float(xp.square(diff, out=diff).sum())
+        if (self.layers[-1].activation_type == 'softmax'):
+            total_err += -float((expected * log(res)).sum())
         return total_err
 
     def fit(
         self, 
         inputs: list[list[float]], 
         expected: list[list[float]],
+    ):
+        xp = self.xp
+        inputs = xp.ascontiguousarray(xp.asarray(inputs, dtype=self.dtype))
+        expected = xp.ascontiguousarray(xp.asarray(expected, dtype=self.dtype))
+        # the numba kernel is plain loops per sample, it only beats the
+        # batched matmuls when it can spread the samples over several threads
+        if (kernels.train_step_batch is not None and kernels.get_num_threads() > 1
+                and self.device == 'cpu' and self.dtype == np.float32):
+            self._train_cache = kernels.build_train_cache(self.layers)
+        self._acts, self._coefs = self._alloc_buffers(min(self.batch_size, len(inputs)))
+        try:
+            return self._fit(inputs, expected)
+        finally:
+            self._train_cache = None
+            self._acts = None
+            self._coefs = None
+            self._err_buf = None
+
+    def _fit(
+        self,
+        inputs: np.ndarray,
+        expected: np.ndarray,
     ):
         num = len(inputs)
         for i in range(self.max_iteration):
-            # permut = [i for i in range(num)]
+            # shuffle once per epoch, the batches are then plain slices
             permut = np.random.permutation(num)
+            shuffled_inputs = inputs[permut]
+            shuffled_expected = expected[permut]
             for j in range(0, num, self.batch_size):
-                bound = min(j + self.batch_size, num)
-                batch_indices = permut[j:bound]
+                cur_inputs = shuffled_inputs[j:j + self.batch_size]
+                cur_expected = shuffled_expected[j:j + self.batch_size]
 
-                cur_inputs = [inputs[i] for i in batch_indices]
-                cur_expected = [expected[i] for i in batch_indices]
-
-                self.multi_propagates(cur_inputs, cur_expected, self.learning_rate)
+                self._batch_propagate(cur_inputs, cur_expected, self.learning_rate)
                 self.update_weights()
-                self.reset_delta_weights()
             total_err = self.calc_total_err(inputs, expected)
             print(f'Iteration {i+1}: {total_err}')
             if total_err < self.error_threshold:
                 return StopReason.ERROR_THRESHOLD
         return StopReason.MAX_ITERATIONS
 
+    def __getstate__(self):
+        # generated code and modules can not be pickled, compile() again
+        # after loading
+        state = self.__dict__.copy()
+        state['_propagate_fn'] = None
+        state['_compiled_arch'] = None
+        del state['xp']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.xp = import_module(DEVICES[self.device])
+
     def save(self, path: str):
         with open(path, 'wb') as f:
             pickle.dump(self, f)
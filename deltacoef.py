@@ -1,18 +1,24 @@
 import numpy as np
 
-def linear(o: float):
-    return 1
+# coefficients are computed from the output of the layer, out may be given
+# to write them into a preallocated buffer
 
-def relu(o: float):
-    if(o < 0):
-        return 0
-    else:
-        return 1
+def linear(o: np.ndarray, out: np.ndarray = None):
+    if out is None:
+        return np.ones_like(o)
+    out.fill(1)
+    return out
 
-def sigmoid(o: float):
-    return o*(1-o)
+def relu(o: np.ndarray, out: np.ndarray = None):
+    return np.greater(o, 0, out=out)
 
-def softmax(o: float):
-    # TODO: implement
-    return 0
+def sigmoid(o: np.ndarray, out: np.ndarray = None):
+    out = np.subtract(1, o, out=out)
+    return np.multiply(o, out, out=out)
 
+def softmax(o: np.ndarray, out: np.ndarray = None):
+    # TODO: implement
+    if out is None:
+        return np.zeros_like(o)
+    out.fill(0)
+    return out
@@ -1,21 +1,18 @@
 import numpy as np
 
 
-def linear(expected: float, value: float):
+def linear(expected: np.ndarray, value: np.ndarray):
     return -(expected-value)
 
 
-def relu(expected: float, value: float):
-    if (value < 0):
-        return 0
-    else:
-        return -(expected - value)
+def relu(expected: np.ndarray, value: np.ndarray):
+    return np.where(value > 0, -(expected - value), 0)
 
 
-def sigmoid(expected: float, value: float):
+def sigmoid(expected: np.ndarray, value: np.ndarray):
     return -value * (1 - value) * (expected - value)
 
 
-def softmax(cur_out: float, other_out: float, cur_idx: int, other_idx: int):
-    print("cur_out", cur_out, other_out, cur_idx, other_idx)
-    return other_out if (cur_idx != other_idx) else (-1 * (1 - cur_out))
+def softmax(expected: np.ndarray, value: np.ndarray):
+    # sum over k of (value[k] if k != j else -(1 - value[j])) * expected[k]
+    return np.sum(value * expected, axis=-1, keepdims=True) - expected
@@ -0,0 +1,213 @@
+import numpy as np
+import ctypes
+import os
+from numpy.ctypeslib import ndpointer
+
+try:
+    from numba import njit, prange, get_num_threads
+    from numba.typed import List
+except ImportError:
+    njit = None
+
+# activation ids used by the compiled kernels
+LINEAR = 0
+RELU = 1
+SIGMOID = 2
+SOFTMAX = 3
+
+ACT_IDS = {
+    'linear': LINEAR,
+    'relu': RELU,
+    'sigmoid': SIGMOID,
+    'softmax': SOFTMAX,
+}
+
+train_step_batch = None
+
+if njit is not None:
+    # error_model='numpy' and no fastmath, so nan and inf propagate like in
+    # numpy instead of raising ZeroDivisionError inside the kernels
+    @njit(cache=True, error_model='numpy')
+    def _activate(act_id, z):
+        n = z.shape[0]
+        if act_id == RELU:
+            for j in range(n):
+                if z[j] < 0:
+                    z[j] = 0
+        elif act_id == SIGMOID:
+            for j in range(n):
+                z[j] = 1 / (1 + np.exp(-z[j]))
+        elif act_id == SOFTMAX:
+            top = z[0]
+            for j in range(1, n):
+                top = max(top, z[j])
+            total = 0.0
+            for j in range(n):
+                z[j] = np.exp(z[j] - top)
+                total += z[j]
+            for j in range(n):
+                z[j] /= total
+
+    @njit(cache=True, error_model='numpy')
+    def _output_delta(act_id, expected, o, delta):
+        n = o.shape[0]
+        if act_id == SOFTMAX:
+            dot = 0.0
+            for j in range(n):
+                dot += o[j] * expected[j]
+            for j in range(n):
+                delta[j] = dot - expected[j]
+        else:
+            for j in range(n):
+                delta[j] = -(expected[j] - o[j])
+                if act_id == RELU and o[j] <= 0:
+                    delta[j] = 0
+                elif act_id == SIGMOID:
+                    delta[j] *= o[j] * (1 - o[j])
+
+    @njit(cache=True, error_model='numpy')
+    def _delta_coef(act_id, o, j):
+        if act_id == RELU:
+            return 1.0 if o[j] > 0 else 0.0
+        elif act_id == SIGMOID:
+            return o[j] * (1 - o[j])
+        elif act_id == SOFTMAX:
+            return 0.0
+        return 1.0
+
+    @njit(cache=True, error_model='numpy')
+    def _sample_step(Ws, dWs, vals, act_ids, x, y, lr):
+        # feed forward and back propagation of one sample, the weight deltas
+        # are accumulated into dWs. vals[i] holds the output of layer i
+        # followed by the bias input of the next layer, x ends with its bias
+        num = len(Ws)
+        prev = x
+        for i in range(num):
+            W = Ws[i]
+            out = vals[i]
+            n, m = W.shape
+            for j in range(n):
+                z = np.float32(0)
+                for k in range(m):
+                    z += W[j, k] * prev[k]
+                out[j] = z
+            _activate(act_ids[i], out[:n])
+            out[n] = 1
+            prev = out
+
+        next_delta = np.empty(0, dtype=np.float32)
+        for i in range(num - 1, -1, -1):
+            W = Ws[i]
+            dW = dWs[i]
+            n, m = W.shape
+            out = vals[i]
+            prev = x if i == 0 else vals[i - 1]
+            delta = np.empty(n, dtype=np.float32)
+            if i == num - 1:
+                _output_delta(act_ids[i], y, out[:n], delta)
+            else:
+                W_next = Ws[i + 1]
+                for j in range(n):
+                    total = np.float32(0)
+                    for k in range(W_next.shape[0]):
+                        total += W_next[k, j] * next_delta[k]
+                    delta[j] = _delta_coef(act_ids[i], out, j) * total
+            for j in range(n):
+                coef = -lr * delta[j]
+                for k in range(m):
+                    dW[j, k] += coef * prev[k]
+            next_delta = delta
+
+    # no explicit signature, so the kernel is compiled by the first fit that
+    # uses it instead of on import
+    @njit(parallel=True, cache=True, error_model='numpy')
+    def train_step_batch(Ws, dWs, act_ids, X, Y, lr, num_threads):
+        # _sample_step over every row of X (padded, bias included), split
+        # across threads. Every thread accumulates into its own shard of
+        # the weight deltas, the shards are added to dWs at the end
+        num = len(Ws)
+        num_threads = min(num_threads, X.shape[0])
+        shards = List()
+        for i in range(num):
+            shards.append(np.zeros((num_threads,) + Ws[i].shape, dtype=np.float32))
+
+        for t in prange(num_threads):
+            dW_local = List()
+            vals = List()
+            for i in range(num):
+                dW_local.append(shards[i][t])
+                width = Ws[i + 1].shape[1] if i < num - 1 else Ws[i].shape[0] + 1
+                vals.append(np.zeros(width, dtype=np.float32))
+            for s in range(t, X.shape[0], num_threads):
+                _sample_step(Ws, dW_local, vals, act_ids, X[s], Y[s], lr)
+
+        for i in range(num):
+            dWs[i] += shards[i].sum(axis=0)
+
+
+def build_train_cache(layers):
+    # typed lists referencing the layer arrays, as expected by train_step_batch
+    Ws = List([layer.W for layer in layers])
+    dWs = List([layer.dW for layer in layers])
+    act_ids = np.array([layer.act_id for layer in layers], dtype=np.int64)
+    return Ws, dWs, act_ids
+
+
+# hand vectorized C kernels (_annkernel.c), only available once built
+_f32_array = ndpointer(np.float32, flags='C_CONTIGUOUS')
+_i8_array = ndpointer(np.int8, flags='C_CONTIGUOUS')
+_i32_array = ndpointer(np.int32, flags='C_CONTIGUOUS')
+
+try:
+    c_lib = ctypes.CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), '_annkernel.so'))
+except OSError:
+    c_lib = None
+
+if c_lib is not None:
+    c_lib.layer_forward.argtypes = [_f32_array, _f32_array, _f32_array, ctypes.c_int, ctypes.c_int]
+    c_lib.layer_forward.restype = None
+    c_lib.gemm_i8_vnni.argtypes = [
+        _i8_array, _f32_array, _i32_array, _f32_array, _f32_array,
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+    ]
+    c_lib.gemm_i8_vnni.restype = None
+
+
+def layer_forward(W, x, z):
+    # z = W @ x, the width of W must be a multiple of 8
+    c_lib.layer_forward(W, x, z, W.shape[0], W.shape[1])
+
+
+def pack_int8(W_q):
+    # blocks of 16 rows x 4 columns as read by gemm_i8_vnni (rows padded to
+    # a multiple of 16, the width must be a multiple of 4), and row sums
+    n, m = W_q.shape
+    padded = np.zeros(((n + 15) & ~15, m), dtype=np.int8)
+    padded[:n] = W_q
+    packed = padded.reshape(-1, 16, m // 4, 4).transpose(0, 2, 1, 3)
+    return np.ascontiguousarray(packed), padded.sum(axis=1, dtype=np.int32)
+
+
+def gemm_i8(W_packed, X, w_sum, w_scale, n_out):
+    # [X, 1] @ W.T of a packed int8 W for a float32 X (one row of inputs
+    # per sample, without the bias), every row is quantized with its own
+    # scale. The first n_out rows of W are kept
+    n, m = W_packed.shape[0] * 16, W_packed.shape[1] * 4
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if c_lib is not None:
+        z = np.empty((X.shape[0], n_out), dtype=np.float32)
+        c_lib.gemm_i8_vnni(W_packed, X, w_sum, w_scale, z, n, m, X.shape[1], n_out, X.shape[0])
+        return z
+
+    A = np.zeros((X.shape[0], m), dtype=np.float32)
+    A[:, :X.shape[1]] = X
+    A[:, X.shape[1]] = 1
+    x_scale = np.abs(A).max(axis=1, keepdims=True) / 127
+    A_q = np.round(A / x_scale)
+    # float32 BLAS instead of an integer matmul, its rounding error is far
+    # below the quantization error
+    W_q = W_packed.transpose(0, 2, 1, 3).reshape(n, m)[:n_out]
+    z = A_q @ W_q.T.astype(np.float32)
+    z *= w_scale[:n_out]
+    z *= x_scale
+    return z
@@ -19,6 +19,7 @@ if __name__ == '__main__':
     parser.add_argument('json_path', type=str, help='path to json test file')
     parser.add_argument('-s', '--save', type=str, help='path to save model')
     parser.add_argument('-l', '--load', type=str, help='path to load model. If specified, json_path will only be used to load the input data')
+    parser.add_argument('-d', '--device', type=str, default='cpu', choices=['cpu', 'cuda'], help='device to train the model on')
     args = parser.parse_args()
     print(args)
 
@@ -27,7 +28,7 @@ if __name__ == '__main__':
     if (args.load is not None):
         model = model_factory.load(args.load)
     else:
-        model = model_factory.build(model_config)
+        model = model_factory.build(model_config, args.device)
 
     model.summary()
 
@@ -77,7 +77,7 @@ def main():
     print(stop_reason)
 
     res = mlp_scratch(data.data)
-    idx_max = [i.index(max(i)) for i in res]
+    idx_max = res.argmax(axis=1)
     
     report_model = classification_report(data.target, idx_max)
 
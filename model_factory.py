@@ -4,14 +4,15 @@ from model_types import ModelConfig
 import pickle
 
 class ModelFactory:
-    def build(self, model_config: ModelConfig) -> Model:
+    def build(self, model_config: ModelConfig, device: str = 'cpu') -> Model:
         case = model_config["case"]
         learning_parameters = case["learning_parameters"]
         model = Model(
             learning_rate=learning_parameters["learning_rate"],
             batch_size=learning_parameters["batch_size"],
             max_iterations=learning_parameters["max_iteration"],
-            error_threshold=learning_parameters["error_threshold"]
+            error_threshold=learning_parameters["error_threshold"],
+            device=device,
         )
         for i in range(len(case["model"]["layers"])):
             layer = case["model"]["layers"][i]